@@ -1,5 +1,5 @@
 import cv2
 
 
-def apply_canny(img, low_threshold, high_threshold):
-    return cv2.Canny(img, low_threshold, high_threshold)
+def apply_canny(img, low_threshold, high_threshold, edges=None):
+    return cv2.Canny(img, low_threshold, high_threshold, edges)
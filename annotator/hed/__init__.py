@@ -96,6 +96,7 @@ class Network(torch.nn.Module):
 # end
 
 netNetwork = None
+batch_size = 8
 remote_model_path = "https://huggingface.co/lllyasviel/ControlNet/resolve/main/annotator/ckpts/network-bsds500.pth"
 modeldir = os.path.join(extensions.extensions_dir, "sd-webui-controlnet", "annotator", "hed")
 
@@ -109,15 +110,21 @@ def apply_hed(input_image):
         netNetwork = Network(modelpath)
     netNetwork.to(devices.get_device_for("controlnet")).eval()
         
-    assert input_image.ndim == 3
-    input_image = input_image[:, :, ::-1].copy()
+    assert input_image.ndim == 3 or input_image.ndim == 4
+    batched = input_image.ndim == 4
+    frames = input_image if batched else input_image[None]
+    edges = []
     with torch.no_grad():
-        image_hed = torch.from_numpy(input_image).float().to(devices.get_device_for("controlnet"))
-        image_hed = image_hed / 255.0
-        image_hed = rearrange(image_hed, 'h w c -> 1 c h w')
-        edge = netNetwork(image_hed)[0]
-        edge = (edge.cpu().numpy() * 255.0).clip(0, 255).astype(np.uint8)
-        return edge[0]
+        # long frame stacks go through the network in chunks to bound memory use
+        for i in range(0, len(frames), batch_size):
+            chunk = frames[i:i + batch_size, :, :, ::-1].copy()
+            image_hed = torch.from_numpy(chunk).float().to(devices.get_device_for("controlnet"))
+            image_hed = image_hed / 255.0
+            image_hed = rearrange(image_hed, 'b h w c -> b c h w')
+            edge = netNetwork(image_hed)[:, 0]
+            edges.append((edge.cpu().numpy() * 255.0).clip(0, 255).astype(np.uint8))
+    edge = np.concatenate(edges)
+    return edge if batched else edge[0]
     
 def unload_hed_model():
     global netNetwork
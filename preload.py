@@ -1,2 +1,19 @@
+import os
+
+
+def setup_cuda_allocator():
+    # preload runs before webui touches cuda, so the caching allocator still picks this up.
+    # only applied when the user hasn't configured the allocator themselves.
+    if "PYTORCH_CUDA_ALLOC_CONF" in os.environ:
+        return
+    import torch
+    from packaging import version
+    # older versions reject the unknown expandable_segments key on the first cuda allocation
+    if version.parse(torch.__version__.split("+")[0]) < version.parse("2.1"):
+        return
+    os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True,max_split_size_mb:512"
+
+
 def preload(parser):
     parser.add_argument("--controlnet-dir", type=str, help="Path to directory with ControlNet models", default=None)
+    setup_cuda_allocator()
@@ -26,7 +26,6 @@ def load_state_dict(ckpt_path, location='cpu'):
     else:
         state_dict = get_state_dict(torch.load(
             ckpt_path, map_location=torch.device(location)))
-    state_dict = get_state_dict(state_dict)
     print(f'Loaded state_dict from [{ckpt_path}]')
     return state_dict
 
@@ -35,14 +34,6 @@ def get_state_dict(d):
     return d.get('state_dict', d)
 
 
-def align(hint, size):
-    b, c, h1, w1 = hint.shape
-    h, w = size
-    if h != h1 or w != w1:
-         hint = torch.nn.functional.interpolate(hint, size=size, mode="nearest")
-    return hint
-
-
 def get_node_name(name, parent_name):
     if len(name) <= len(parent_name):
         return False, ''
@@ -60,41 +51,49 @@ class PlugableControlModel(nn.Module):
         self.control_model = ControlNet(**config.model.params.control_stage_config.params)
         state_dict = load_state_dict(model_path)
         
-        if any([k.startswith("control_model.") for k, v in state_dict.items()]):
+        if any(k.startswith("control_model.") for k in state_dict):
             
             is_diff_model = 'difference' in state_dict
             transfer_ctrl_opt = shared.opts.data.get("control_net_control_transfer", False) and \
-                any([k.startswith("model.diffusion_model.") for k, v in state_dict.items()])
+                any(k.startswith("model.diffusion_model.") for k in state_dict)
                 
             if (is_diff_model or transfer_ctrl_opt) and base_model is not None:
                 # apply transfer control - https://github.com/lllyasviel/ControlNet/blob/main/tool_transfer_control.py
                 
                 unet_state_dict = base_model.state_dict()
                 unet_state_dict_keys = unet_state_dict.keys()
-                final_state_dict = {}
-                counter = 0
+                dst_values, unet_values, frozen_values = [], [], []
                 for key in state_dict.keys():
                     if not key.startswith("control_model."):
                         continue
                     
-                    p = state_dict[key]
                     is_control, node_name = get_node_name(key, 'control_')
                     key_name = node_name.replace("model.", "") if is_control else key
 
                     if key_name in unet_state_dict_keys:
-                        if is_diff_model:
-                            # transfer control by make difference in advance
-                            p_new = p + unet_state_dict[key_name].clone().cpu()
-                        else:
-                            # transfer control by calculate offsets from (delta = p + current_unet_encoder - frozen_unet_encoder)
-                            p_new = p + unet_state_dict[key_name].clone().cpu() - state_dict["model.diffusion_model."+key_name]
-                        counter += 1
-                    else:
-                        p_new = p
-                    final_state_dict[key] = p_new
+                        # .cpu() already copies when the unet lives on the gpu
+                        unet_value = unet_state_dict[key_name].cpu()
+                        p = state_dict[key]
+                        dtype = torch.result_type(p, unet_value)
+                        if not is_diff_model:
+                            frozen_value = state_dict["model.diffusion_model."+key_name]
+                            dtype = torch.promote_types(dtype, frozen_value.dtype)
+                            frozen_values.append(frozen_value)
+                        if p.dtype != dtype:
+                            # keep the promoted precision of an out-of-place sum, e.g. bf16 diff + fp16 unet -> fp32
+                            p = p.to(dtype)
+                            state_dict[key] = p
+                        dst_values.append(p)
+                        unet_values.append(unet_value)
+
+                if dst_values:
+                    # diff models made the difference in advance, so adding the current unet is enough
+                    torch._foreach_add_(dst_values, unet_values)
+                    if not is_diff_model:
+                        # transfer control by calculate offsets from (delta = p + current_unet_encoder - frozen_unet_encoder)
+                        torch._foreach_sub_(dst_values, frozen_values)
                     
-                print(f'Offset cloned: {counter} values')
-                state_dict = final_state_dict
+                print(f'Offset cloned: {len(dst_values)} values')
                 
             state_dict = {k.replace("control_model.", ""): v for k, v in state_dict.items() if k.startswith("control_model.")}
         else:
@@ -105,38 +104,90 @@ class PlugableControlModel(nn.Module):
         self.lowvram = lowvram            
         self.weight = weight
         self.only_mid_control = False
+        self.only_mid_control_hires = shared.opts.data.get("control_net_only_midctrl_hires", True)
         self.control = None
         self.hint_cond = None
+        self.hint_ready = None
+        self.guided_hint = None
+
+        device = devices.get_device_for("controlnet")
+        use_streams = device.type == 'cuda'
+        # the control net only meets the unet at the middle block, run it on a side stream to overlap the encoder.
+        # memory freed on the side stream can't be reused by the unet, so low vram setups keep running in sequence
+        low_vram_mode = self.lowvram or shared.cmd_opts.lowvram or shared.cmd_opts.medvram
+        self.cn_stream = torch.cuda.Stream(device=device) if use_streams and not low_vram_mode else None
+        self.copy_stream = torch.cuda.Stream(device=device) if use_streams else None
         
         if not self.lowvram:
-            self.control_model.to(devices.get_device_for("controlnet"))
+            self.control_model.to(device)
+
+        self.compiled = False
+        if not self.lowvram and shared.opts.data.get("control_net_compile", False) and hasattr(torch, "compile"):
+            # lowvram moves the weights on every call, which would keep invalidating compiled graphs
+            try:
+                self.control_model = torch.compile(self.control_model, dynamic=False)
+                self.compiled = True
+            except Exception as e:
+                # torch 2.0 refuses to compile on Windows and Python 3.11
+                print(f'Warning: torch.compile is not supported here, running ControlNet without it: {e}')
+
+    def run_control_model(self, **kwargs):
+        if self.compiled:
+            try:
+                return self.control_model(**kwargs)
+            except Exception as e:
+                # compilation happens on the first call, that's where missing triton or old gpus fail
+                print(f'Warning: torch.compile failed, running ControlNet without it: {e}')
+                self.control_model = self.control_model._orig_mod
+                self.compiled = False
+        return self.control_model(**kwargs)
 
     def hook(self, model, parent_model):
         outer = self
 
         def forward(self, x, timesteps=None, context=None, **kwargs):
             only_mid_control = outer.only_mid_control
+
+            if outer.hint_ready is not None:
+                current_stream = torch.cuda.current_stream(x.device)
+                current_stream.wait_event(outer.hint_ready)
+                outer.hint_cond.record_stream(current_stream)
+                outer.hint_ready = None
             
             # hires stuffs
             # note that this method may not works if hr_scale < 1.1
             if abs(x.shape[-1] - outer.hint_cond.shape[-1] // 8) > 8:
-                only_mid_control = shared.opts.data.get("control_net_only_midctrl_hires", True)
+                only_mid_control = outer.only_mid_control_hires
                 # If you want to completely disable control net, uncomment this.
                 # return self._original_forward(x, timesteps=timesteps, context=context, **kwargs)
             
-            control = outer.control_model(x=x, hint=outer.hint_cond, timesteps=timesteps, context=context)
             assert timesteps is not None, ValueError(f"insufficient timestep: {timesteps}")
+            # the sinusoidal embedding is shared, each model still applies its own time_embed
+            t_emb = timestep_embedding(
+                timesteps, self.model_channels, repeat_only=False)
+
+            if outer.cn_stream is not None:
+                outer.cn_stream.wait_stream(torch.cuda.current_stream(x.device))
+            with torch.cuda.stream(outer.cn_stream), torch.inference_mode():
+                # the hint features only depend on the hint and the latent size, compute them once per size
+                if outer.guided_hint is None or outer.guided_hint.shape[-2:] != x.shape[-2:]:
+                    outer.guided_hint = outer.control_model.guide(outer.hint_cond, *x.shape[-2:])
+                control = outer.run_control_model(x=x, hint=outer.hint_cond, timesteps=timesteps, context=context, t_emb=t_emb, guided_hint=outer.guided_hint)
             hs = []
             with torch.no_grad():
-                t_emb = timestep_embedding(
-                    timesteps, self.model_channels, repeat_only=False)
                 emb = self.time_embed(t_emb)
-                h = x.type(self.dtype)
+                h = x if x.dtype == self.dtype else x.to(self.dtype)
                 for module in self.input_blocks:
                     h = module(h, emb, context)
                     hs.append(h)
                 h = self.middle_block(h, emb, context)
 
+            if outer.cn_stream is not None:
+                current_stream = torch.cuda.current_stream(x.device)
+                current_stream.wait_stream(outer.cn_stream)
+                for c in control:
+                    c.record_stream(current_stream)
+
             h += control.pop()
 
             for i, module in enumerate(self.output_blocks):
@@ -144,11 +195,12 @@ class PlugableControlModel(nn.Module):
                     h = torch.cat([h, hs.pop()], dim=1)
                 else:
                     hs_input, control_input = hs.pop(), control.pop()
-                    h = align(h, hs_input.shape[-2:])
+                    if h.shape[-2:] != hs_input.shape[-2:]:
+                        h = torch.nn.functional.interpolate(h, size=hs_input.shape[-2:], mode="nearest")
                     h = torch.cat([h, hs_input + control_input * outer.weight], dim=1)
                 h = module(h, emb, context)
 
-            h = h.type(x.dtype)
+            h = h if h.dtype == x.dtype else h.to(x.dtype)
             return self.out(h)
 
         def forward2(*args, **kwargs):
@@ -167,8 +219,21 @@ class PlugableControlModel(nn.Module):
         model.forward = forward2.__get__(model, UNetModel)
     
     def notify(self, cond_like, weight):
+        device = devices.get_device_for("controlnet")
+        if self.copy_stream is not None and cond_like.device.type == 'cpu':
+            # upload from pinned memory on a side stream, the first forward waits on the event
+            cond_like = cond_like.pin_memory()
+            with torch.cuda.stream(self.copy_stream):
+                cond_like = cond_like.to(device, non_blocking=True)
+            self.hint_ready = torch.cuda.Event()
+            self.hint_ready.record(self.copy_stream)
+        else:
+            cond_like = cond_like.to(device)
+            self.hint_ready = None
         self.hint_cond = cond_like
+        self.guided_hint = None
         self.weight = weight
+        self.only_mid_control_hires = shared.opts.data.get("control_net_only_midctrl_hires", True)
         # print(self.hint_cond.shape)
 
     def restore(self, model):
@@ -281,7 +346,7 @@ class ControlNet(nn.Module):
         )
         self.zero_convs = nn.ModuleList([self.make_zero_conv(model_channels)])
 
-        self.input_hint_block = TimestepEmbedSequential(
+        self.input_hint_block = nn.Sequential(
             conv_nd(dims, hint_channels, 16, 3, padding=1),
             nn.SiLU(),
             conv_nd(dims, 16, 16, 3, padding=1),
@@ -416,39 +481,50 @@ class ControlNet(nn.Module):
         self.middle_block_out = self.make_zero_conv(ch)
         self._feature_size += ch
 
+        # plain list for the hot loop in forward, rebuild it if input_blocks or zero_convs are ever modified.
+        # zero convs are a bare 1x1 conv, so keep the conv itself and skip the TimestepEmbedSequential dispatch
+        self._paired = [(module, zero_conv[0]) for module, zero_conv in zip(self.input_blocks, self.zero_convs)]
+
     def make_zero_conv(self, channels):
         return TimestepEmbedSequential(zero_module(conv_nd(self.dims, channels, channels, 1, padding=0)))
     
     def align(self, hint, h, w):
         c, h1, w1 = hint.shape
         if h != h1 or w != w1:
-            hint = align(hint.unsqueeze(0), (h, w))
+            hint = torch.nn.functional.interpolate(hint.unsqueeze(0), size=(h, w), mode="nearest")
             return hint.squeeze(0)
         return hint
 
-    def forward(self, x, hint, timesteps, context, **kwargs):
-        t_emb = timestep_embedding(
-            timesteps, self.model_channels, repeat_only=False)
-        emb = self.time_embed(t_emb)
-
-            
-        guided_hint = self.input_hint_block(hint, emb, context)
-        outs = []
-        
-        h1, w1 = x.shape[-2:]
-        guided_hint = self.align(guided_hint, h1, w1)
-
-        h = x.type(self.dtype)
-        for module, zero_conv in zip(self.input_blocks, self.zero_convs):
-            if guided_hint is not None:
-                h = module(h, emb, context)
-                h += guided_hint
-                guided_hint = None
-            else:
-                h = module(h, emb, context)
-            outs.append(zero_conv(h, emb, context))
+    def guide(self, hint, h, w):
+        with devices.autocast():
+            dtype = next(self.input_hint_block.parameters()).dtype
+            hint = hint if hint.dtype == dtype else hint.to(dtype)
+            return self.align(self.input_hint_block(hint), h, w)
+
+    def forward(self, x, hint, timesteps, context, t_emb=None, guided_hint=None, **kwargs):
+        if t_emb is None:
+            t_emb = timestep_embedding(
+                timesteps, self.model_channels, repeat_only=False)
+        # runs under webui's autocast when sampling, but keep the control model in half precision when called directly
+        with devices.autocast():
+            emb = self.time_embed(t_emb)
+
+            if guided_hint is None:
+                h1, w1 = x.shape[-2:]
+                guided_hint = self.guide(hint, h1, w1)
+            outs = []
+
+            h = x if x.dtype == self.dtype else x.to(self.dtype)
+            for module, zero_conv in self._paired:
+                if guided_hint is not None:
+                    h = module(h, emb, context)
+                    h += guided_hint
+                    guided_hint = None
+                else:
+                    h = module(h, emb, context)
+                outs.append(zero_conv(h))
 
-        h = self.middle_block(h, emb, context)
-        outs.append(self.middle_block_out(h, emb, context))
+            h = self.middle_block(h, emb, context)
+            outs.append(self.middle_block_out[0](h))
 
-        return outs
\ No newline at end of file
+            return outs
\ No newline at end of file
@@ -1,5 +1,6 @@
 import os
 import stat
+import threading
 from collections import OrderedDict
 
 import torch
@@ -14,6 +15,7 @@ from modules import sd_models
 from torchvision.transforms import Resize, InterpolationMode, CenterCrop, Compose
 from scripts.cldm import PlugableControlModel
 from scripts.processor import *
+from scripts.processor import _preload_annotators
 from modules.ui_components import ToolButton
 
 CN_MODEL_EXTS = [".pt", ".pth", ".ckpt", ".safetensors"]
@@ -318,9 +320,9 @@ class Script(scripts.Script):
         detected_map = HWC3(detected_map)
         
         if module == "normal_map" or rgbbgr_mode:
-            control = torch.from_numpy(detected_map[:, :, ::-1].copy()).float().to(devices.get_device_for("controlnet")) / 255.0
+            control = torch.from_numpy(detected_map[:, :, ::-1].copy()).float() / 255.0
         else:
-            control = torch.from_numpy(detected_map.copy()).float().to(devices.get_device_for("controlnet")) / 255.0
+            control = torch.from_numpy(detected_map.copy()).float() / 255.0
         
         control = rearrange(control, 'h w c -> c h w')
         detected_map = rearrange(torch.from_numpy(detected_map), 'h w c -> c h w')
@@ -388,10 +390,18 @@ def on_ui_settings():
         False, "Do not append detectmap to output", gr.Checkbox, {"interactive": True}, section=section))
     shared.opts.add_option("control_net_only_midctrl_hires", shared.OptionInfo(
         True, "Use mid-layer control on highres pass (second pass)", gr.Checkbox, {"interactive": True}, section=section))
+    shared.opts.add_option("control_net_compile", shared.OptionInfo(
+        False, "Compile ControlNet models with torch.compile (requires PyTorch 2.0, first step will be slow)", gr.Checkbox, {"interactive": True}, section=section))
     shared.opts.add_option("control_net_allow_script_control", shared.OptionInfo(
         False, "Allow other script to control this extension", gr.Checkbox, {"interactive": True}, section=section))
 
     # control_net_skip_hires
 
 
+def on_app_started(demo, app):
+    # import the annotators once everything else is loaded, off the main thread
+    threading.Thread(target=_preload_annotators, daemon=True).start()
+
+
 script_callbacks.on_ui_settings(on_ui_settings)
+script_callbacks.on_app_started(on_app_started)
@@ -1,32 +1,54 @@
 
+import functools
 import numpy as np
 from annotator.util import resize_image, HWC3
 
 
+def _resize_frames(img, res):
+    # accepts a single HWC image or a NHWC stack of frames
+    if img.ndim == 4:
+        return np.stack([resize_image(HWC3(frame), res) for frame in img])
+    return resize_image(HWC3(img), res)
+
+
+def _per_frame(fn):
+    # lets a single image preprocessor take a NHWC stack of frames, one frame at a time
+    @functools.wraps(fn)
+    def wrapper(img, *args, **kwargs):
+        if img.ndim == 4:
+            return np.stack([fn(frame, *args, **kwargs) for frame in img])
+        return fn(img, *args, **kwargs)
+    return wrapper
+
+
 model_canny = None
 
 
 def canny(img, res=512, l=100, h=200):
-    img = resize_image(HWC3(img), res)
+    img = _resize_frames(img, res)
     global model_canny
     if model_canny is None:
         from annotator.canny import apply_canny
         model_canny = apply_canny
+    if img.ndim == 4:
+        result = np.empty(img.shape[:3], dtype=np.uint8)
+        for frame, edges in zip(img, result):
+            model_canny(frame, l, h, edges)
+        return result
     result = model_canny(img, l, h)
     return result
 
 def simple_scribble(img, res=512):
     img = resize_image(HWC3(img), res)
-    result = np.zeros_like(img, dtype=np.uint8)
-    result[np.min(img, axis=2) < 127] = 255
-    return result
+    result = np.where(np.min(img, axis=2) < 127, np.uint8(255), np.uint8(0))
+    return np.repeat(result[:, :, None], 3, axis=2)
 
 
 model_hed = None
 
 
 def hed(img, res=512):
-    img = resize_image(HWC3(img), res)
+    img = _resize_frames(img, res)
     global model_hed
     if model_hed is None:
         from annotator.hed import apply_hed
@@ -40,20 +62,22 @@ def unload_hed():
         from annotator.hed import unload_hed_model
         unload_hed_model()
 
+@_per_frame
 def fake_scribble(img, res=512):
     result = hed(img, res)
     import cv2
     from annotator.hed import nms
     result = nms(result, 127, 3.0)
-    result = cv2.GaussianBlur(result, (0, 0), 3.0)
-    result[result > 10] = 255
-    result[result < 255] = 0
+    # nms returns a fresh map, blur and threshold it in place
+    cv2.GaussianBlur(result, (0, 0), 3.0, dst=result)
+    cv2.threshold(result, 10, 255, cv2.THRESH_BINARY, dst=result)
     return result
 
 
 model_mlsd = None
 
 
+@_per_frame
 def mlsd(img, res=512, thr_v=0.1, thr_d=0.1):
     img = resize_image(HWC3(img), res)
     global model_mlsd
@@ -73,6 +97,7 @@ def unload_mlsd():
 model_midas = None
 
 
+@_per_frame
 def midas(img, res=512, a=np.pi * 2.0):
     img = resize_image(HWC3(img), res)
     global model_midas
@@ -82,6 +107,7 @@ def midas(img, res=512, a=np.pi * 2.0):
     results, _ = model_midas(img, a)
     return results
 
+@_per_frame
 def midas_normal(img, res=512, a=np.pi * 2.0, bg_th=0.4):
     img = resize_image(HWC3(img), res)
     global model_midas
@@ -101,6 +127,7 @@ def unload_midas():
 model_openpose = None
 
 
+@_per_frame
 def openpose(img, res=512, has_hand=False):
     img = resize_image(HWC3(img), res)
     global model_openpose
@@ -110,6 +137,7 @@ def openpose(img, res=512, has_hand=False):
     result, _ = model_openpose(img, has_hand)
     return result
 
+@_per_frame
 def openpose_hand(img, res=512, has_hand=True):
     img = resize_image(HWC3(img), res)
     global model_openpose
@@ -129,6 +157,7 @@ def unload_openpose():
 model_uniformer = None
 
 
+@_per_frame
 def uniformer(img, res=512):
     img = resize_image(HWC3(img), res)
     global model_uniformer
@@ -142,4 +171,15 @@ def unload_uniformer():
     global model_uniformer
     if model_uniformer is not None:
         from annotator.uniformer import unload_uniformer_model
-        unload_uniformer_model()
\ No newline at end of file
+        unload_uniformer_model()
+
+
+def _preload_annotators():
+    # warm up the annotator imports so the first preprocessor call doesn't pay for them,
+    # the apply_* functions are still picked up lazily on first use
+    for name in ("canny", "hed", "mlsd", "midas", "openpose", "uniformer"):
+        try:
+            __import__(f"annotator.{name}")
+        except Exception as e:
+            # the actual preprocessor call will raise it again
+            print(f"Failed to preload annotator {name}: {e}")